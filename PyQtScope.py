@@ -19,8 +19,12 @@
 import os
 import sys
 import glob
+import array
+import bisect
 import struct
 
+from functools import lru_cache
+
 import usb.core
 import usb.util
 import usb.backend.libusb1
@@ -35,28 +39,39 @@ from matplotlib.figure import Figure
 from matplotlib.ticker import Formatter, FuncFormatter
 
 from PyQt5.uic import loadUiType
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QThread, QTimer
 from PyQt5.QtWidgets import QApplication, QMainWindow, QMenu, QVBoxLayout, QSizePolicy, QMessageBox, QWidget, QDialog, QFileDialog, QProgressDialog
 
 Ui_PyQtScope, QMainWindow = loadUiType('PyQtScope.ui')
 
+# USBTMC bulk message header parts: MsgID/bTag/bTagInverse and TransferSize/bmTransferAttributes
+header_id = struct.Struct('BBBx')
+header_size = struct.Struct('<LBxxx')
+
+metric_thresholds = [1.0e-9, 1.0e-6, 1.0e-3, 1.0e0, 1.0e3, 1.0e6]
+metric_scales = [1.0, 1.0e+9, 1.0e+6, 1.0e+3, 1.0e0, 1.0e-3, 1.0e-6]
+metric_formats = ['%g ', '%g n', '%g u', '%g m', '% g ', '%g k', '%g M']
+
+@lru_cache(maxsize = 256)
 def metric_prefix(x):
   if x == 0.0:
     return '0 '
-  elif abs(x) >= 1.0e6:
-    return '%g M' % (x * 1.0e-6)
-  elif abs(x) >= 1.0e3:
-    return '%g k' % (x * 1.0e-3)
-  elif abs(x) >= 1.0e0:
-    return '% g ' % x
-  elif abs(x) >= 1.0e-3:
-    return '%g m' % (x * 1e+3)
-  elif abs(x) >= 1.0e-6:
-    return '%g u' % (x * 1e+6)
-  elif abs(x) >= 1.0e-9:
-    return '%g n' % (x * 1e+9)
-  else:
-    return '%g ' % x
+  i = bisect.bisect_right(metric_thresholds, abs(x))
+  return metric_formats[i] % (x * metric_scales[i])
+
+
+class SaveThread(QThread):
+
+  def __init__(self, name, table):
+    super(SaveThread, self).__init__()
+    self.name = name
+    self.table = table
+
+  def run(self):
+    fmt = '%16.11f;%14.9f;%14.9f\n' * 2500
+    with open(self.name, 'wb', buffering = 1 << 20) as fh:
+      fh.write(b'     t          ;     ch1      ;     ch2\n')
+      fh.write((fmt % tuple(self.table.ravel())).encode())
 
 
 class PyQtScope(QMainWindow, Ui_PyQtScope):
@@ -67,13 +82,24 @@ class PyQtScope(QMainWindow, Ui_PyQtScope):
   def __init__(self):
     super(PyQtScope, self).__init__()
     self.setupUi(self)
-    # data buffers
-    self.buffer1 = bytearray(2500)
-    self.buffer2 = bytearray(2500)
-    self.data1 = np.frombuffer(self.buffer1, np.int8)
-    self.data2 = np.frombuffer(self.buffer2, np.int8)
-    self.format1 = ['0'] * 11
-    self.format2 = ['0'] * 11
+    # one buffer holding both raw CURV? responses: 6-byte header, 2500 samples, line feed each
+    self.raw = bytearray(2 * 2507)
+    self.rawviews = [memoryview(self.raw)[:2507], memoryview(self.raw)[2507:]]
+    self.samples = np.frombuffer(self.raw, np.int8).reshape(2, 2507)[:, 6:2506]
+    self.xincr = 0.0
+    self.xzero = 0.0
+    self.ymult1 = 0.0
+    self.yoff1 = 0.0
+    self.ymult2 = 0.0
+    self.yoff2 = 0.0
+    # sample-code-to-volts lookup table indexed by channel and the uint8 view of the samples
+    self.codes = np.arange(256, dtype = np.uint8).view(np.int8)
+    self.lut = np.zeros((2, 256))
+    # time axis, recomputed in place when the horizontal parameters are read
+    self.index = np.arange(2500, dtype = np.float64)
+    self.times = np.zeros(2500)
+    # staging table for the CSV export: t, ch1 and ch2 columns
+    self.table = np.zeros((2500, 3))
     # create figure
     self.figure = Figure()
     self.figure.set_facecolor('none')
@@ -81,16 +107,19 @@ class PyQtScope(QMainWindow, Ui_PyQtScope):
     self.axes = self.figure.add_subplot(111)
     self.canvas = FigureCanvas(self.figure)
     self.plotLayout.addWidget(self.canvas)
-    self.curve1, = self.axes.plot(np.zeros(2500), color = self.colors[0])
-    self.curve2, = self.axes.plot(np.zeros(2500), color = self.colors[1])
+    self.curve1, = self.axes.plot(np.zeros(2500), color = self.colors[0], animated = True)
+    self.curve2, = self.axes.plot(np.zeros(2500), color = self.colors[1], animated = True)
     self.axes.set_xticks(np.arange(0, 2501, 250))
     self.axes.set_yticks(np.arange(-100, 101, 25))
     self.axes.set_xticklabels([])
     self.axes.set_yticklabels([])
     self.axes.grid()
-    self.sca1 = None
-    self.sca2 = None
-    self.scam = None
+    self.sca1 = self.figure.text(0.01, 0.01, '', color = self.colors[0], animated = True)
+    self.sca2 = self.figure.text(0.31, 0.01, '', color = self.colors[1], animated = True)
+    self.scam = self.figure.text(0.61, 0.01, '', animated = True)
+    # blitting: the full scene is drawn once and cached, then only the curves and labels are redrawn
+    self.background = None
+    self.canvas.mpl_connect('draw_event', self.update_background)
     # create navigation toolbar
     self.toolbar = NavigationToolbar(self.canvas, self.plotWidget, False)
     # remove subplots action
@@ -100,8 +129,10 @@ class PyQtScope(QMainWindow, Ui_PyQtScope):
     # connect signals from buttons and boxes
     self.readButton.clicked.connect(self.read_data)
     self.saveButton.clicked.connect(self.save_data)
+    self.saver = None
     # setup USB connection
     self.btag = 0
+    self.txbuf = array.array('B', bytes(128))
     self.device = None
     if os.name == 'nt':
       backend = usb.backend.libusb1.get_backend(find_library = lambda x: 'libusb-1.0.dll')
@@ -142,29 +173,61 @@ class PyQtScope(QMainWindow, Ui_PyQtScope):
       self.transmit_command(b'*IDN?')
       print(self.receive_result())
 
+  def update_background(self, event):
+    self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+    self.axes.draw_artist(self.curve1)
+    self.axes.draw_artist(self.curve2)
+    self.figure.draw_artist(self.sca1)
+    self.figure.draw_artist(self.sca2)
+    self.figure.draw_artist(self.scam)
+
+  def update_plot(self):
+    if self.background is None:
+      self.canvas.draw_idle()
+      return
+    self.canvas.restore_region(self.background)
+    self.axes.draw_artist(self.curve1)
+    self.axes.draw_artist(self.curve2)
+    self.figure.draw_artist(self.sca1)
+    self.figure.draw_artist(self.sca2)
+    self.figure.draw_artist(self.scam)
+    self.canvas.blit(self.figure.bbox)
+    self.canvas.flush_events()
+
   def transmit_command(self, command):
     if os.name == 'nt':
       size = len(command)
+      pad = (4 - (size % 4)) % 4
       self.btag = (self.btag % 255) + 1
-      data = struct.pack('BBBx', 1, self.btag, ~self.btag & 0xFF)
-      data += struct.pack('<LBxxx', size, 1)
-      data += command + b'\0'*((4 - (size % 4)) % 4)
-      self.device.write(0x06, data, 1000)
+      header_id.pack_into(self.txbuf, 0, 1, self.btag, ~self.btag & 0xFF)
+      header_size.pack_into(self.txbuf, 4, size, 1)
+      self.txbuf[12:12+size+pad] = array.array('B', command + b'\0'*pad)
+      self.device.write(0x06, self.txbuf[:12+size+pad], 1000)
     else:
       self.device.write(command + b'\n')
 
-  def receive_result(self, size = None):
+  def receive_result(self, size = None, out = None):
     if os.name == 'nt':
-      result = b''
+      request = 1024 if size is None else size
+      chunks = []
+      offset = 0
       stop = 0
       while not stop:
         self.btag = (self.btag % 255) + 1
-        data = struct.pack('BBBx', 2, self.btag, ~self.btag & 0xFF)
-        data += struct.pack('<LBxxx', 1024, 0)
-        self.device.write(0x06, data, 1000)
-        data = self.device.read(0x85, 1036, 1000).tobytes()
-        size, stop = struct.unpack_from('<LBxxx', data, 4)
-        result += data[12:size+12]
+        header_id.pack_into(self.txbuf, 0, 2, self.btag, ~self.btag & 0xFF)
+        header_size.pack_into(self.txbuf, 4, request, 0)
+        self.device.write(0x06, self.txbuf[:12], 1000)
+        data = self.device.read(0x85, (request + 12 + 3) & ~3, 1000)
+        count, stop = header_size.unpack_from(data, 4)
+        if out is None:
+          chunks.append(data[12:count+12].tobytes())
+        else:
+          out[offset:offset+count] = memoryview(data)[12:count+12]
+          offset += count
+      result = b''.join(chunks)
+    elif out is not None:
+      self.device.readinto(out)
+      result = None
     elif size is None:
       result = self.device.readline()
     else:
@@ -194,33 +257,31 @@ class PyQtScope(QMainWindow, Ui_PyQtScope):
       # read channel and time scales
       self.transmit_command(b'CH1:SCA?;:CH2:SCA?;:HOR:MAI:SCA?')
       sca = self.receive_result()[:-1].decode('utf-8').rsplit(';')
-      if self.sca1:
-        self.sca1.remove()
-        self.sca1 = None
-      self.sca1 = self.figure.text(0.01, 0.01, 'CH1 %sV' % metric_prefix(float(sca[0])), color = self.colors[0])
-      if self.sca2:
-        self.sca2.remove()
-        self.sca2 = None
-      self.sca2 = self.figure.text(0.31, 0.01, 'CH2 %sV' % metric_prefix(float(sca[1])), color = self.colors[1])
-      if self.scam:
-        self.scam.remove()
-        self.scam = None
-      self.scam = self.figure.text(0.61, 0.01, 'M %ss' % metric_prefix(float(sca[2])))
+      self.sca1.set_text('CH1 %sV' % metric_prefix(float(sca[0])))
+      self.sca2.set_text('CH2 %sV' % metric_prefix(float(sca[1])))
+      self.scam.set_text('M %ss' % metric_prefix(float(sca[2])))
       progress.setValue(1)
       # read formats
-      self.transmit_command(b'WFMPre:CH1?')
-      self.format1 = self.receive_result()[:-1].decode('utf-8').rsplit(';')
-      self.transmit_command(b'WFMPre:CH2?')
-      self.format2 = self.receive_result()[:-1].decode('utf-8').rsplit(';')
+      self.transmit_command(b'WFMPre:CH1?;:WFMPre:CH2?')
+      fmt = self.receive_result()[:-1].decode('utf-8').rsplit(';')
+      self.xincr = float(fmt[2])
+      self.xzero = float(fmt[4])
+      self.ymult1 = float(fmt[6])
+      self.yoff1 = float(fmt[8])
+      self.ymult2 = float(fmt[17])
+      self.yoff2 = float(fmt[19])
+      self.lut = (self.codes - np.array([[self.yoff1], [self.yoff2]])) * np.array([[self.ymult1], [self.ymult2]])
+      np.multiply(self.index, self.xincr, out = self.times)
+      self.times += self.xzero
       progress.setValue(2)
       # read curves
       self.transmit_command(b'DAT:SOU CH1;:CURV?')
-      self.buffer1[:] = self.receive_result(2507)[6:-1]
-      self.curve1.set_ydata(self.data1)
+      self.receive_result(2507, self.rawviews[0])
+      self.curve1.set_ydata(self.samples[0])
       self.transmit_command(b'DAT:SOU CH2;:CURV?')
-      self.buffer2[:] = self.receive_result(2507)[6:-1]
-      self.curve2.set_ydata(self.data2)
-      self.canvas.draw()
+      self.receive_result(2507, self.rawviews[1])
+      self.curve2.set_ydata(self.samples[1])
+      self.update_plot()
       progress.setValue(3)
       # read measurements
       self.transmit_command(b'MEASU:MEAS1?;:MEASU:MEAS1:VAL?;:MEASU:MEAS2?;:MEASU:MEAS2:VAL?;:MEASU:MEAS3?;:MEASU:MEAS3:VAL?')
@@ -232,16 +293,17 @@ class PyQtScope(QMainWindow, Ui_PyQtScope):
         typ = meas[i * 4 + 0]
         uni = meas[i * 4 + 1]
         sou = meas[i * 4 + 2]
-        val = meas[i * 4 + 3]
         if typ == 'NONE':
           val = ''
           uni = ''
-        elif abs(float(val)) > 9.9E9:
-          val = '?'
-          uni = ''
         else:
-          val = metric_prefix(float(meas[i * 4 + 3]))
-          uni = uni.strip('"')
+          value = float(meas[i * 4 + 3])
+          if abs(value) > 9.9E9:
+            val = '?'
+            uni = ''
+          else:
+            val = metric_prefix(value)
+            uni = uni.strip('"')
         getattr(self, 'meas%d' % (i + 1)).setText('%s %s %s%s' % (sou, typ, val, uni))
       progress.setValue(4)
       # read cursors
@@ -249,20 +311,18 @@ class PyQtScope(QMainWindow, Ui_PyQtScope):
       curs = self.receive_result()[:-1].decode('utf-8').rsplit(';')
       self.curst.setText('%s %s' % (curs[1], self.cursors[curs[0]]))
       if curs[0] == 'VBARS':
+        self.curs1.setText('%ss' % (metric_prefix(float(curs[3]))))
         val = float(curs[8])
         if abs(val) > 9.9E9:
-          self.curs1.setText('%ss' % (metric_prefix(float(curs[3]))))
           self.curs2.setText('')
         else:
-          self.curs1.setText('%ss' % (metric_prefix(float(curs[3]))))
-          self.curs2.setText('%sV' % (metric_prefix(float(curs[8]))))
+          self.curs2.setText('%sV' % (metric_prefix(val)))
+        self.curs3.setText('%ss' % (metric_prefix(float(curs[4]))))
         val = float(curs[9])
         if abs(val) > 9.9E9:
-          self.curs3.setText('%ss' % (metric_prefix(float(curs[4]))))
           self.curs4.setText('')
         else:
-          self.curs3.setText('%ss' % (metric_prefix(float(curs[4]))))
-          self.curs4.setText('%sV' % (metric_prefix(float(curs[9]))))
+          self.curs4.setText('%sV' % (metric_prefix(val)))
         self.delta.setText('dt = %ss' % (metric_prefix(float(curs[11]))))
       elif curs[0] == 'HBARS':
         self.curs1.setText('%sV' % metric_prefix(float(curs[6])))
@@ -282,20 +342,24 @@ class PyQtScope(QMainWindow, Ui_PyQtScope):
       progress.setValue(5)
 
   def save_data(self):
+    if self.saver:
+      self.saver.wait()
     dialog = QFileDialog(self, 'Write csv file', '.', '*.csv')
     dialog.setDefaultSuffix('csv')
     dialog.setAcceptMode(QFileDialog.AcceptSave)
     dialog.setOptions(QFileDialog.DontConfirmOverwrite)
-    t = np.linspace(0.0, 2499.0, 2500) * float(self.format1[2]) + float(self.format1[4])
-    ch1 = (self.data1 - float(self.format1[8])) * float(self.format1[6])
-    ch2 = (self.data2 - float(self.format2[8])) * float(self.format2[6])
+    self.table[:, 0] = self.times
+    self.table[:, 1] = self.lut[0, self.samples[0].view(np.uint8)]
+    self.table[:, 2] = self.lut[1, self.samples[1].view(np.uint8)]
     if dialog.exec() == QDialog.Accepted:
       name = dialog.selectedFiles()
-      fh = open(name[0], 'w')
-      fh.write('     t          ;     ch1      ;     ch2\n')
-      for i in range(0, 2500):
-        fh.write('%16.11f;%14.9f;%14.9f\n' % (t[i], ch1[i], ch2[i]))
-      fh.close()
+      self.saver = SaveThread(name[0], self.table)
+      self.saver.start()
+
+  def closeEvent(self, event):
+    if self.saver:
+      self.saver.wait()
+    event.accept()
 
 app = QApplication(sys.argv)
 window = PyQtScope()